@@ -1,14 +1,25 @@
 import pymupdf
+import numpy as np
 import json
 import argparse
 import logging
-from copy import deepcopy
+from collections import defaultdict
+from operator import attrgetter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 PDF_ANNOT_TEXT = (0, 'Text')
 PDF_ANNOT_STRIKE_OUT = (11, 'StrikeOut')
 PDF_ANNOT_CARET = (14, 'Caret')
 
-SELECT_TEXT_ANNOTS = {"Replace", "StrikeOut", "Highlight", "Underline"}
+# types of the annotations which can make up a 'Replace', see isReplaceAnnot(). Full (code, name) tuples,
+# like the rest of isReplaceAnnot() and the response types, so three-element /IT variants don't count
+REPLACE_PART_TYPES = frozenset({PDF_ANNOT_STRIKE_OUT, PDF_ANNOT_CARET})
+
+# type codes which page.annots() doesn't yield, see pageAnnots()
+SKIPPED_ANNOT_TYPE_CODES = frozenset({pymupdf.PDF_ANNOT_LINK, pymupdf.PDF_ANNOT_POPUP, pymupdf.PDF_ANNOT_WIDGET})
+
+SELECT_TEXT_ANNOTS = frozenset({"Replace", "StrikeOut", "Highlight", "Underline"})
 
 # When extracting selection text I alter the bounding boxes slightly to avoid repeating or missing symbols.
 # The value of two points was chosen heuristically; it works well enough for the time being on the PDFs I've tested.
@@ -16,8 +27,20 @@ SELECT_TEXT_ANNOTS = {"Replace", "StrikeOut", "Highlight", "Underline"}
 CARET_BUFF = 2 # in pymupdf points
 EXTRACT_TEXT_BUFFER_WIDTH = 2 # also in pymupdf points
 
+# Only the line bounding boxes are used from page.get_text('dict'), so don't have MuPDF decode and copy
+# every image on the page into the dict as well (image blocks also have no 'lines' anyway)
+LINE_BBOX_TEXT_FLAGS = pymupdf.TEXTFLAGS_DICT & ~pymupdf.TEXT_PRESERVE_IMAGES
+
+# MuPDF keeps the fonts and images it decodes for get_text() in its store (capped at TOOLS.store_maxsize,
+# 256 MB by default), but a page's resources are rarely needed again once it has been read, so the store
+# is shrunk by this percentage after every page. See releaseStore()
+STORE_SHRINK_PERCENT = 100
+
 class Annot:
-    """Revised version of pymupdf's Annot which fixes the bounding box of the Caret annotation and isn't fragile. See getRobustAnnots()"""
+    """Revised version of pymupdf's Annot which fixes the bounding box of the Caret annotation and isn't fragile. See getRobustAnnots()
+       rect is a plain (x0, y0, x1, y1) tuple; it's only turned into a pymupdf.Rect where pymupdf needs one"""
+    __slots__ = ('pageno', 'type', 'info', 'xref', 'irt_xref', 'rect', 'intersecting_line_bb', 'creation_date')
+
     def __init__ (self, _pageno, _type, _info, _xref, _irt_xref, _rect, _intersecting_line_bb):
         self.pageno = _pageno        
         self.type = _type
@@ -26,6 +49,7 @@ class Annot:
         self.irt_xref = _irt_xref
         self.rect = _rect
         self.intersecting_line_bb = _intersecting_line_bb
+        self.creation_date = _info.get('creationDate', '') # responses are sorted by it, see getResponses()
         
     def __str__ (self):
         return str({'pageno':self.pageno,
@@ -49,7 +73,7 @@ class Edit:
                  The Edit types are mostly a subset of the Annot types (full list at
                  https://pymupdf.readthedocs.io/en/latest/vars.html#annotationtypes) with the exception
                  of "Replace" which corresponds to the combination of a Strikeout and Caret annotation
-                 which are identified by isReplaceAnnot in getCorrections(), not by pymupdf. 
+                 which are identified by isReplaceAnnot(), not by pymupdf. 
     
     "message":   text in the annotation comment box and responses to it---typically edit directions
                  if it's not already self-evident from the type (e.g., Strikeout). The message itself
@@ -69,6 +93,8 @@ class Edit:
     }
 
     """
+    __slots__ = ('pageno', 'type', 'message', 'selection', 'debug_bbs')
+
     def __init__ (self, _pageno, _type, _message, _selection, _debug_bbs):
         self.pageno = _pageno
         self.type = _type
@@ -90,7 +116,120 @@ class Edit:
     def __repr__ (self):
         return str(self)
 
-def getRobustAnnots(doc):
+def lineBBoxArray(blocks):
+    """return the line bounding boxes of page.get_text('dict')['blocks'] as an (N,4) array with columns x0, y0, x1, y1"""
+    return np.fromiter((c for block in blocks for line in block['lines'] for c in line['bbox']),
+                       dtype=np.float64).reshape(-1, 4)
+
+class LineIndex:
+    """
+    Static index over the line bounding boxes of a page, built once per page.
+
+    Empty line bboxes (which pymupdf.Rect.intersects() never matches) are dropped and the rest are sorted by y0,
+    so a rectangle query only has to look at the lines which start above the rectangle's bottom edge
+    (found by binary search) instead of every line on the page.
+    """
+    def __init__ (self, blocks):
+        line_arr = lineBBoxArray(blocks)
+        nonempty = np.flatnonzero((line_arr[:,0] < line_arr[:,2]) & (line_arr[:,1] < line_arr[:,3]))
+        self.order = nonempty[np.argsort(line_arr[nonempty,1], kind='stable')] # original position of each sorted line
+        self.bbs = line_arr[self.order]
+
+    def query(self, rects):
+        """
+        vectorized pymupdf.Rect.intersects() for every pair of rects and lines at once: return an array
+        mask[i, j] which is True if rects[i] intersects self.bbs[j]. Only lines with y0 less than the lowest
+        rect bottom can intersect anything, so the remaining columns are never compared.
+        """
+        if len(rects) == 0:
+            return np.zeros((0, 0), dtype=bool)
+        r = np.array([tuple(rect) for rect in rects], dtype=np.float64).reshape(-1, 4)
+        k = np.searchsorted(self.bbs[:,1], r[:,3].max(), side='left')
+        cand = self.bbs[:k]
+        return (((r[:,0] < r[:,2]) & (r[:,1] < r[:,3]))[:,None] # rect is not empty
+                & (cand[None,:,0] < r[:,2,None]) & (r[:,0,None] < cand[None,:,2])
+                & (cand[None,:,1] < r[:,3,None]) & (r[:,1,None] < cand[None,:,3]))
+
+    def highestBaselines(self, rects):
+        """
+        return, for each rect, the bbox of the intersecting line with the smallest y1 (ties go to the line
+        that comes first in the page's text order) and the number of intersecting lines
+        """
+        mask = self.query(rects)
+        num_intersecting = mask.sum(axis=1)
+        k = mask.shape[1]
+        if k == 0:
+            return [(None, 0)] * len(rects)
+        y1s = np.where(mask, self.bbs[None,:k,3], np.inf)
+        is_highest = mask & (y1s == y1s.min(axis=1, initial=np.inf)[:,None])
+        highest = np.argmin(np.where(is_highest, self.order[None,:k], np.iinfo(np.intp).max), axis=1)
+        return [(tuple(self.bbs[j].tolist()) if n > 0 else None, int(n)) for j, n in zip(highest, num_intersecting)]
+
+def rectsIntersect(a, b):
+    """pymupdf.Rect.intersects() for (x0, y0, x1, y1) tuples: both are non-empty and overlap with positive area"""
+    ax0, ay0, ax1, ay1 = a
+    bx0, by0, bx1, by1 = b
+    return (ax0 < ax1 and ay0 < ay1 and bx0 < bx1 and by0 < by1
+            and ax0 < bx1 and bx0 < ax1 and ay0 < by1 and by0 < ay1)
+
+def pageAnnots(page):
+    """
+    Generator over the same annotations as page.annots(), which looks every annotation up again by
+    its xref with page.load_annot(); walking MuPDF's linked list of annotations avoids that.
+    """
+    annot = page.first_annot
+    while annot:
+        if annot.type[0] not in SKIPPED_ANNOT_TYPE_CODES:
+            yield annot
+        annot = annot.next
+
+def releaseStore():
+    """empty (part of) MuPDF's resource store after a page is done with. See STORE_SHRINK_PERCENT"""
+    pymupdf.TOOLS.store_shrink(STORE_SHRINK_PERCENT)
+    logging.debug(f"MuPDF store size after shrinking: {pymupdf.TOOLS.store_size} bytes (max {pymupdf.TOOLS.store_maxsize})")
+
+def getPageRobustAnnots(page, pageno):
+    """return the robust annotations of a single page. See getRobustAnnots()"""
+    page_annots = []
+    # every property of a pymupdf.Annot goes back to MuPDF, so only read the ones which are used, once
+    # (the rect is kept as a plain (x0, y0, x1, y1) tuple, see Annot)
+    annots = [(annot.type, annot.info, annot.xref, annot.irt_xref, tuple(annot.rect)) for annot in pageAnnots(page)]
+    if not annots:
+        # most pages of a lightly annotated PDF have nothing to resolve, so don't extract their text at all
+        return page_annots
+    blocks = page.get_text('dict', flags=LINE_BBOX_TEXT_FLAGS, sort=True)['blocks']
+    line_index = LineIndex(blocks)
+    baselines = iter(line_index.highestBaselines([rect for annot_type, _, _, _, rect in annots if annot_type != PDF_ANNOT_TEXT]))
+    for annot_type, info, xref, irt_xref, annotRect in annots:
+        if annot_type == PDF_ANNOT_TEXT:
+            page_annots.append(Annot(pageno,annot_type,info,xref,irt_xref,annotRect,None))
+            continue
+
+        ## bbbox = (x0, y0, x1, y1)
+        highest_baseline_line_bb, num_intersecting = next(baselines)
+        assert num_intersecting > 0, "num_intersecting <= 0 should not happen: it should always intersect at least one"
+
+        ## fix caret rect
+        if annot_type == PDF_ANNOT_CARET: 
+            annotRect = (*annotRect[:3], highest_baseline_line_bb[3])
+
+        if num_intersecting > 1:
+            logging.debug("Annot intersects with more than one line bbox:", info)
+            
+        page_annots.append(Annot(pageno,annot_type,info,xref,irt_xref,annotRect,highest_baseline_line_bb))
+
+    return page_annots
+
+def _robustAnnotsOfPages(filename, pagenos):
+    """process pool worker for getRobustAnnots()"""
+    page_annots = dict()
+    with pymupdf.open(filename) as doc:
+        for pageno in pagenos:
+            page_annots[pageno] = getPageRobustAnnots(doc[pageno], pageno)
+            releaseStore()
+    return page_annots
+
+def getRobustAnnots(doc, jobs = 1):
     """
     The bounding boxes of the original caret annotations often extend below the line they
     were inserted on, so they are resized to prevent that.
@@ -99,49 +238,33 @@ def getRobustAnnots(doc):
     come from (so when the page goes away, so does the annotation), and I've encountered issues
     with using the provided methods to update the annotations, so I'll just store the
     annotations with my own class which isn't tied to the page and correctly stores the information.
+
+    Pages are independent, so with jobs > 1 they are split between that many worker processes
+    (pymupdf holds a global lock, so threads wouldn't help).
     """
     robust_annots = {pageno:[] for pageno in range(doc.page_count)}
-    for pageno, page in enumerate(doc):
-        blocks = page.get_text('dict', sort=True)['blocks']
-        line_bbs = [line['bbox'] for block in blocks for line in block['lines']]
-        for annot in page.annots():
-            annotRect = annot.rect
-            intersecting_line_bbs = list(filter(lambda l: annotRect.intersects(l), line_bbs))
-
-            if annot.type == PDF_ANNOT_TEXT:
-                robust_annots[pageno].append(Annot(pageno,annot.type,annot.info,annot.xref,annot.irt_xref,annotRect,None))
-                continue
-
-            assert len(intersecting_line_bbs) > 0, "len(intersecting_line_bbs) <= 0 should not happen: it should always intersect at least one"
-            
-            ## bbbox = (x0, y0, x1, y1)
-            highest_baseline_line_bb = sorted(intersecting_line_bbs, key = lambda bb : bb[3])[0]
-
-            ## fix caret rect
-            if annot.type == PDF_ANNOT_CARET: 
-                raisedRect = pymupdf.Rect(annotRect.top_left, annotRect.bottom_right)
-                raisedRect.y1 = highest_baseline_line_bb[3]
-                annotRect = raisedRect
-
-            if len(intersecting_line_bbs) > 1:
-                logging.debug("Annot intersects with more than one line bbox:", annot.info)
-                
-            robust_annots[pageno].append(Annot(pageno,annot.type,annot.info,annot.xref,annot.irt_xref,annotRect,highest_baseline_line_bb))
+    if jobs > 1 and doc.name:
+        # pymupdf documents can't be shared between processes, so every worker opens its own copy
+        page_chunks = [range(i, doc.page_count, jobs) for i in range(jobs)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for chunk_annots in executor.map(_robustAnnotsOfPages, repeat(doc.name), page_chunks):
+                robust_annots.update(chunk_annots)
+        return robust_annots
 
+    for pageno, page in enumerate(doc):
+        robust_annots[pageno] = getPageRobustAnnots(page, pageno)
+        releaseStore()
     return robust_annots
 
 def getAllResponses(robust_annots):
     """return dictionary where dict[xref] => [annots for which annot.irt_xref == xref]"""
-    all_responses = dict()
+    all_responses = defaultdict(list)
     for pageno, annots in robust_annots.items():
         for annot in annots: 
             if annot.irt_xref == 0:
                 continue
-            if annot.irt_xref in all_responses:
-                all_responses[annot.irt_xref].append(annot)
-            else:
-                all_responses[annot.irt_xref] = [annot]
-    return all_responses
+            all_responses[annot.irt_xref].append(annot)
+    return dict(all_responses)
 
 def getResponses(annot, all_responses):
     """
@@ -151,51 +274,71 @@ def getResponses(annot, all_responses):
     if annot.xref not in all_responses:
         return []
 
-    resps_by_type = dict()
+    resps_by_type = defaultdict(list)
     for resp in all_responses[annot.xref]:
-        if resp.type not in resps_by_type:
-            resps_by_type[resp.type] = [resp]
-        else:
-            resps_by_type[resp.type].append(resp)
+        resps_by_type[resp.type].append(resp)
 
-    for ann_type, resps in resps_by_type.items():
-        resps_by_type[ann_type] = sorted(resps, key = lambda r: r.info['creationDate'])
+    for resps in resps_by_type.values():
+        if len(resps) > 1:
+            resps.sort(key = attrgetter('creation_date'))
     
-    return resps_by_type
+    return dict(resps_by_type)
 
-def getSelection(ann, doc):
-    """return an annotation's selected text (and the bounding boxes for debugging purposes)"""
+def getSelection(ann, page, textpage=None):
+    """
+    return an annotation's selected text (and the bounding boxes for debugging purposes).
+    textpage is page's pymupdf.TextPage, which is built once and shared by every annotation on the page
+    (page.get_textbox() otherwise extracts the whole page's text again for every rectangle)
+    """
     buff = EXTRACT_TEXT_BUFFER_WIDTH
     selection_name = ann.type[1]
-    page = doc[ann.pageno]
+    if textpage is None:
+        textpage = page.get_textpage()
     x0, y0, x1, y1 = ann.intersecting_line_bb
+    ann_x0, _, ann_x1, _ = ann.rect
     
     if selection_name == PDF_ANNOT_CARET[1]:
-        insertion_point_x = ann.rect.x0 + ann.rect.width/2
+        insertion_point_x = (ann_x0 + ann_x1)/2
         left_rect = pymupdf.Rect(x0, y0, insertion_point_x-CARET_BUFF, y1)
         right_rect = pymupdf.Rect(insertion_point_x+CARET_BUFF, y0, x1, y1)
-        return '{left}<Caret></Caret>{right}'.format(left = page.get_textbox(left_rect),
-                                                     right = page.get_textbox(right_rect)), (left_rect, right_rect)
+        return '{left}<Caret></Caret>{right}'.format(left = page.get_textbox(left_rect, textpage),
+                                                     right = page.get_textbox(right_rect, textpage)), (left_rect, right_rect)
 
     elif selection_name in SELECT_TEXT_ANNOTS:
-        left_rect = pymupdf.Rect(x0, y0, ann.rect.x0-buff, y1)
-        middle_rect = pymupdf.Rect(ann.rect.x0+buff/2, y0, ann.rect.x1-buff/2, y1)
-        right_rect = pymupdf.Rect(ann.rect.x1+buff, y0, x1, y1)
-        return '{left}<{name}>{middle}</{name}>{right}'.format(left = page.get_textbox(left_rect),
-                                                               middle = page.get_textbox(middle_rect),
-                                                               right = page.get_textbox(right_rect),
+        left_rect = pymupdf.Rect(x0, y0, ann_x0-buff, y1)
+        middle_rect = pymupdf.Rect(ann_x0+buff/2, y0, ann_x1-buff/2, y1)
+        right_rect = pymupdf.Rect(ann_x1+buff, y0, x1, y1)
+        return '{left}<{name}>{middle}</{name}>{right}'.format(left = page.get_textbox(left_rect, textpage),
+                                                               middle = page.get_textbox(middle_rect, textpage),
+                                                               right = page.get_textbox(right_rect, textpage),
                                                                name = selection_name), (left_rect, middle_rect, right_rect)
     else:
         return None
     
-def getCorrections(filename):
+def isReplaceAnnot(ann, ann_resps):
+    """return whether ann and one of its responses combine into a 'Replace' annotation (and that response)"""
+    if ann.type not in REPLACE_PART_TYPES or ann_resps == []:
+        return False, None
+
+    assert ann.type not in ann_resps, "{} are in response to annotation of same type {}".format(str(ann_resps[ann.type]), str(ann))
+    assert len(ann_resps.keys()) <= 2, "ann {} has responses {} of more than two types".format(ann, ann_resps)
+
+    other_ann_type = PDF_ANNOT_STRIKE_OUT if ann.type == PDF_ANNOT_CARET else PDF_ANNOT_CARET
+    if not (other_ann_type in ann_resps and len(ann_resps[other_ann_type]) == 1):
+        return False, None
+    other_ann = ann_resps[other_ann_type][0]
+
+    return rectsIntersect(ann.rect, other_ann.rect) and other_ann.info['content'] == '', other_ann
+
+def getCorrections(filename, jobs = 1):
     """return a list of Edits. See class Edit."""
     doc = pymupdf.open(filename)
-    robust_annots = getRobustAnnots(doc)
+    robust_annots = getRobustAnnots(doc, jobs)
     all_responses = getAllResponses(robust_annots)
     
     corrections = []
     for pageno, page in enumerate(doc):
+        textpage = None
         for annot in robust_annots[pageno]: 
             if annot.irt_xref != 0:
                 # only true for text responses and annotations which combine
@@ -206,20 +349,6 @@ def getCorrections(filename):
             text_responses = [resp.info['content'] for resp in text_responses]
             message = {'comment': annot.info['content'], 'responses': text_responses}            
 
-            def isReplaceAnnot(ann, ann_resps):
-                if not (ann.type == PDF_ANNOT_STRIKE_OUT or ann.type == PDF_ANNOT_CARET) or ann_resps == []:
-                    return False, None
-                
-                assert ann.type not in ann_resps, "{} are in response to annotation of same type {}".format(str(ann_resps[ann.type]), str(ann))
-                assert len(ann_resps.keys()) <= 2, "ann {} has responses {} of more than two types".format(ann, ann_resps)
-                
-                other_ann_type = PDF_ANNOT_STRIKE_OUT if ann.type == PDF_ANNOT_CARET else PDF_ANNOT_CARET
-                if not (other_ann_type in ann_resps and len(ann_resps[other_ann_type]) == 1):
-                    return False, None
-                other_ann = ann_resps[other_ann_type][0]
-
-                return ann.rect.intersects(other_ann.rect) and other_ann.info['content'] == '', other_ann
-                
             is_replace, other_ann = isReplaceAnnot(annot, responses)
             
             if is_replace:
@@ -227,8 +356,11 @@ def getCorrections(filename):
                     annot.rect = other_ann.rect
                 annot.type = (None, 'Replace')
 
-            selection_text, bbs = getSelection(annot, doc)
+            if textpage is None:
+                textpage = page.get_textpage()
+            selection_text, bbs = getSelection(annot, page, textpage)
             corrections.append(Edit(annot.pageno, annot.type[1], message, selection_text, bbs))
+        releaseStore()
                 
     return corrections
             
@@ -237,6 +369,7 @@ if __name__ == '__main__':
                                      description = 'Return edits from annotated pdf as json')
     parser.add_argument('filename')
     parser.add_argument("-d", "--debug", action="store_true", help='debugging output')
+    parser.add_argument("-j", "--jobs", type=int, default=1, help='number of processes used to read the annotations')
     
     args = parser.parse_args()
     
@@ -245,6 +378,6 @@ if __name__ == '__main__':
     
     logging.basicConfig(level=_level, format='%(asctime)s - %(levelname)s - %(message)s')
     
-    corrections = getCorrections(filename)
+    corrections = getCorrections(filename, args.jobs)
     for cor in corrections:
         print(cor)
@@ -4,8 +4,7 @@ def normalize_whitespace(s: str) -> str:
     return ' '.join(s.split())
 
 def largest_common_substring(A, B):
-    matcher = difflib.SequenceMatcher(None, A, B)
-    match = max(matcher.get_matching_blocks(), key=lambda x: x.size)
+    match = difflib.SequenceMatcher(None, A, B).find_longest_match(0, len(A), 0, len(B))
     return A[match.a : match.a + match.size]
 
 A = "This is a short sentence with some words."
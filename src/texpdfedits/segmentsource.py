@@ -2,21 +2,28 @@ import argparse
 import logging
 import re
 
-# simple TeX parser
-from TexSoup import TexSoup 
-# more complex TeX parser and converter
+# TeX parser and converter
 from pylatexenc.latexwalker import LatexWalker, LatexEnvironmentNode, LatexMacroNode, LatexMathNode, LatexCharsNode, LatexGroupNode 
-from pylatexenc.macrospec import LatexContextDb, MacroSpec, EnvironmentSpec
+from pylatexenc.macrospec import LatexContextDb, MacroSpec, EnvironmentSpec, MacroStandardArgsParser
 
-from itertools import count
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import sys
 import subprocess
+import hashlib
+import shutil
+import pickle
 
 METADATA_FIELDS = ['title', 'author', 'address', 'email', 'thanks', 'subjclass', 'keywords', 'datereceived', 'daterevised', 'abstract']
 UNIQUE_FIELDS = {'title', 'subjclass', 'datereceived', 'keywords', 'abstract'}
-ALLOWED_MARK_ENVIRONMENTS = {'proof', 'enumerate', 'itemize', 'document', 'thebibliography', 'biblist', 'bibdiv', 'bibsec'}
+## pylatexenc argspecs of the metadata macros and \newtheorem
+METADATA_ARGSPEC = '[{'
+NEWTHEOREM_ARGSPEC = '*{'
+## words which get a \markbox in markNode(): runs of letters with whitespace on both sides.
+## The word is captured so MARK_WORD_PATTERN.split() returns it between the text around it
+MARK_WORD_PATTERN = re.compile(r"(?<=[\t\n ])\b([a-zA-Z]+)\b(?=[\t\n ])")
+ALLOWED_MARK_ENVIRONMENTS = frozenset({'proof', 'enumerate', 'itemize', 'document', 'thebibliography', 'biblist', 'bibdiv', 'bibsec'})
 
 DIFFPDF_DPI = 175
 ## so far it appears for some reason \eqrefs produce very small differences in
@@ -31,6 +38,29 @@ DIFFPDF_DPI = 175
 ## so I think marking a page as not different if it differs by less than 50_000 pixels at this DPI is quite conservative.
 DIFFPDF_PER_PAGE_PIXEL_TOLERANCE = 50_000
 
+## compiled PDFs are cached under the pdflatex output directory, see runPdflatex().
+## Bump LATEX_CACHE_VERSION to invalidate every cached compilation
+LATEX_CACHE_DIRNAME = '.latex_cache'
+LATEX_CACHE_VERSION = 1
+
+## the results of parsing and marking the source are cached next to them, see parseAndMarkCached().
+## Bump PARSE_CACHE_VERSION whenever getMetadata(), getEnunciations() or markNode() change what they return
+PARSE_CACHE_DIRNAME = '.parse_cache'
+PARSE_CACHE_VERSION = 1
+
+## the files pdflatex reads back in on its next pass. When a pass leaves all of them unchanged,
+## another pass would typeset exactly the same thing, see runPdflatex()
+RERUN_FILE_SUFFIXES = ('.aux', '.toc', '.lof', '.lot', '.out')
+## what LaTeX (and packages like hyperref, longtable and natbib) log when they need another pass
+RERUN_LOG_PATTERN = re.compile(rb'Rerun|rerun LaTeX')
+
+## how much of pdflatex's .log to show when a pass fails
+PDFLATEX_ERROR_LOG_LINES = 20
+
+## stop at the first error instead of pressing on through the rest of the document;
+## segment() exits on any failed pass anyway
+PDFLATEX_OPTIONS = ('-interaction=nonstopmode', '-halt-on-error')
+
 SCALED_POINTS_PER_TEX_POINT = 2 ** 16 # 65536
 
 ## there are 72.27 tex pts in an inch, while there are 
@@ -38,25 +68,75 @@ SCALED_POINTS_PER_TEX_POINT = 2 ** 16 # 65536
 ## pymupdf and other modern pdf systems use
 TEX_POINTS_TO_PDF_POINTS_CONVERSION_RATIO = 72 / 72.27
 
+## lines of the \markfile written by \markbox (see segment()): key:label:page:value:value:value.
+## Matched against the whole (undecoded) file at once, see getWordBoxes()
+BOX_LINE_PATTERN = re.compile(rb"^[ \t]*(m?\d+):(pwhd|spxy|epxy):(\d+):([^:\s]*):([^:\s]*):([^:\s]*)[ \t\r]*$", re.MULTILINE)
+
 ## allow for half a point discrepancy between x0 + width and x1
 ## in boxinfoToPDFRectangle()
 WORD_BOX_WIDTH_TOLERANCE = 1
 
 def sourceAsString(filename: str) -> str:
-    with open(filename, 'r', encoding = 'utf-8') as f:
-        tex_file_str = f.read()
+    """read the whole file as bytes and decode it once, instead of through the incremental text decoder.
+       Line endings are still normalized to '\\n' like they would be in text mode"""
+    with open(filename, 'rb') as f:
+        tex_file_str = f.read().decode('utf-8')
+    if '\r' in tex_file_str:
+        tex_file_str = tex_file_str.replace('\r\n', '\n').replace('\r', '\n')
     return tex_file_str
 
-def getMetadata(soup) -> dict[str, list | str]:
-    r"""Extracts metadata, issuing warnings if a unique field appears more than once
-       soup.find_all() fails if multiple comments are used like
-       `\author[J. Malone]%
-       %
-       {John Malone}` which shouldn't really appear anyway. Comments will typically be removed from the souce.
+def getLatexNodes(tex_str: str):
+    """parse tex_str with pylatexenc. No macros are given argument specs, so every node's latex_verbatim() is just
+       the source it was parsed from (and a macro's arguments are the nodes which follow it)"""
+    latex_context = LatexContextDb()
+    # latex_context.add_context_category('macros',macros=[MacroSpec('mark', args_parser='{')])
+    nodelist, _, _ = LatexWalker(tex_str, latex_context=latex_context).get_latex_nodes(pos=0)
+    return nodelist
+
+def nodesSpanSource(nodelist, source: str, start: int = 0, end: int | None = None) -> bool:
+    """For nodes parsed from source, same as ''.join([node.latex_verbatim() for node in nodelist]) == source[start:end]
+       without building the string: every node's latex_verbatim() is the slice source[node.pos:node.pos+node.len],
+       so the nodes reproduce the source exactly when their slices are contiguous and cover [start, end)"""
+    end = len(source) if end is None else end
+    pos = start
+    for node in nodelist:
+        if node.pos != pos:
+            return False
+        pos += node.len
+    return pos == end
+
+def findLatexNodes(nodelist, names) -> dict[str, list]:
+    """return dict[name] => [macro and environment nodes called name], searching nodelist and every nested node in document order"""
+    found = {name: [] for name in names}
+    stack = list(reversed(nodelist))
+    while stack:
+        node = stack.pop()
+        if node.isNodeType(LatexMacroNode) and node.macroname in found:
+            found[node.macroname].append(node)
+        elif node.isNodeType(LatexEnvironmentNode) and node.envname in found:
+            found[node.envname].append(node)
+        stack.extend(reversed(getattr(node, 'nodelist', None) or []))
+    return found
+
+def parseMacroArgs(macro_node, argspec: str):
+    """parse the arguments following macro_node according to argspec (see pylatexenc.macrospec.MacroStandardArgsParser).
+       return the source of the macro together with its arguments and the list of parsed argument nodes"""
+    parsing_state = macro_node.parsing_state
+    walker = LatexWalker(parsing_state.s, latex_context=parsing_state.latex_context)
+    argd, pos, length = MacroStandardArgsParser(argspec).parse_args(w=walker, pos=macro_node.pos+macro_node.len, parsing_state=parsing_state)
+    return parsing_state.s[macro_node.pos:pos+length], argd.argnlist
+
+def getMetadata(nodelist) -> dict[str, list | str]:
+    r"""Extracts metadata, issuing warnings if a unique field appears more than once.
+       nodelist is the output of getLatexNodes() (a TeX string is also accepted and parsed).
+       Each field is the verbatim source of the macro (including its optional and mandatory arguments) or environment.
     """
+    if isinstance(nodelist, str):
+        nodelist = getLatexNodes(nodelist)
     metadata = dict()
-    for field in METADATA_FIELDS:
-        metadata[field] = [str(s) for s in soup.find_all(field)]
+    for field, nodes in findLatexNodes(nodelist, METADATA_FIELDS).items():
+        metadata[field] = [parseMacroArgs(node, METADATA_ARGSPEC)[0] if node.isNodeType(LatexMacroNode) else node.latex_verbatim()
+                           for node in nodes]
         if field in UNIQUE_FIELDS:
             num_fields = len(metadata[field])
             if num_fields != 1:
@@ -65,36 +145,90 @@ def getMetadata(soup) -> dict[str, list | str]:
                 metadata[field] = str(metadata[field][0])
     return metadata
 
-def getEnunciations(soup) -> set[str]:
-    r"""gets the names of enunciations declared with \newtheorem"""
-    newthms = soup.find_all('newtheorem')
+def getEnunciations(nodelist) -> set[str]:
+    r"""gets the names of enunciations declared with \newtheorem.
+       nodelist is the output of getLatexNodes() (a TeX string is also accepted and parsed)."""
+    if isinstance(nodelist, str):
+        nodelist = getLatexNodes(nodelist)
     enunciation_names = set()
-    for thm in newthms:
-        if len(thm.args) < 1:
-            logging.error(fr'Somehow a \newtheorem macro has less than one argument as parsed by TexSoup... exiting.')
+    for thm in findLatexNodes(nodelist, ['newtheorem'])['newtheorem']:
+        _, (_, name) = parseMacroArgs(thm, NEWTHEOREM_ARGSPEC)
+        if name is None:
+            logging.error(fr'Somehow a \newtheorem macro has less than one argument as parsed by pylatexenc... exiting.')
             sys.exit(1)
-        enunciation_names.add(str(thm.args[0].string))
+        enunciation_names.add(''.join(n.latex_verbatim() for n in name.nodelist) if name.isNodeType(LatexGroupNode) else name.latex_verbatim())
     return enunciation_names
 
-def runPdflatex(tex_str: str, tex_basename: str, output_dir: Path, runs: int = 2) -> subprocess.CompletedProcess:
-    """Run pdflatex. Run twice by default to resolve cross-references"""
+def pdflatexCacheKey(tex_str: str, tex_basename: str, runs: int) -> str:
+    """the jobname and number of passes change pdflatex's output as well as the source itself"""
+    return hashlib.sha256(f'{LATEX_CACHE_VERSION}:{tex_basename}:{runs}:{tex_str}'.encode('utf-8')).hexdigest()
+
+def rerunFilesSnapshot(output_dir: Path, stem: str) -> tuple[bytes | None, ...]:
+    """contents of the RERUN_FILE_SUFFIXES files of jobname stem (None for the ones which don't exist)"""
+    paths = [output_dir / (stem+suffix) for suffix in RERUN_FILE_SUFFIXES]
+    return tuple(path.read_bytes() if path.exists() else None for path in paths)
+
+def logTail(log_path: Path, num_lines: int) -> str:
+    """the last num_lines lines of a TeX log (which isn't necessarily utf-8)"""
+    if not log_path.exists():
+        return f'({log_path} was not written)'
+    return '\n'.join(log_path.read_text(encoding='latin-1').splitlines()[-num_lines:])
+
+def runPdflatex(tex_str: str, tex_basename: str, output_dir: Path, runs: int = 2,
+                extra_outputs: tuple[str, ...] = (), use_cache: bool = True) -> subprocess.CompletedProcess:
+    r"""Run pdflatex. Run (at most) twice by default to resolve cross-references. Passes stop early once a pass
+       leaves the auxiliary files unchanged and nothing in the log asks for a rerun, since the next pass would
+       read back exactly what this one did
+
+       A pass which can't be the last one (there is no .aux from an earlier compile for it to read yet) runs
+       with -draftmode, which typesets everything, writes the auxiliary files and skips writing the PDF.
+       Passes only stop early after a non-draft pass, so the PDF is always from the last pass.
+
+       The resulting PDF (and extra_outputs, files like the \markfile written by the TeX itself) are cached
+       in output_dir/LATEX_CACHE_DIRNAME keyed on a hash of tex_str, so compiling the same source again just
+       copies the cached files. Only tex_str is hashed: changes to files it \inputs or includes won't be noticed,
+       so pass use_cache = False if those change.
+    """
     with open(output_dir / tex_basename, 'w', encoding='utf-8') as f:
         f.write(tex_str)
+
+    outputs = [Path(tex_basename).stem+'.pdf', *extra_outputs]
+    cache_dir = output_dir / LATEX_CACHE_DIRNAME / pdflatexCacheKey(tex_str, tex_basename, runs)
+    if use_cache and all((cache_dir / fname).exists() for fname in outputs):
+        logging.info(f"Using cached pdflatex output for {tex_basename} from {cache_dir}")
+        for fname in outputs:
+            shutil.copyfile(cache_dir / fname, output_dir / fname)
+        return subprocess.CompletedProcess(['pdflatex', *PDFLATEX_OPTIONS, tex_basename], 0)
     
+    stem = Path(tex_basename).stem
+    rerun_files = rerunFilesSnapshot(output_dir, stem)
     result = None
     for i in range(runs):
-        logging.info(f"Running pdflatex (pass {i+1}/{runs})")
+        draft = i+1 < runs and rerun_files[RERUN_FILE_SUFFIXES.index('.aux')] is None
+        logging.info(f"Running pdflatex on {tex_basename} (pass {i+1}/{runs}{', draft' if draft else ''})")
+        ## everything pdflatex prints also goes to its .log, so don't collect and decode it here
         result = subprocess.run(
-            ['pdflatex', '-interaction=nonstopmode', tex_basename],
+            ['pdflatex', *PDFLATEX_OPTIONS, *(['-draftmode'] if draft else []), tex_basename],
             cwd=output_dir,
-            capture_output=True, # see result.stdout, result.stderr
-            text=True,
-            encoding='latin-1'
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
         )
         
         if result.returncode != 0:
-            logging.error(f"pdflatex failed on pass {i+1} of {tex_basename}: {result.stderr}.")
+            log_path = output_dir / (stem+'.log')
+            logging.error(f"pdflatex failed on pass {i+1} of {tex_basename}. End of {log_path}:\n{logTail(log_path, PDFLATEX_ERROR_LOG_LINES)}")
             sys.exit(1)
+
+        if i+1 < runs:
+            prev_rerun_files, rerun_files = rerun_files, rerunFilesSnapshot(output_dir, stem)
+            if not draft and rerun_files == prev_rerun_files and not RERUN_LOG_PATTERN.search((output_dir / (stem+'.log')).read_bytes()):
+                logging.info(f"Auxiliary files of {tex_basename} are unchanged after pass {i+1}; skipping the remaining passes")
+                break
+
+    if use_cache:
+        Path.mkdir(cache_dir, parents = True, exist_ok = True)
+        for fname in outputs:
+            shutil.copyfile(output_dir / fname, cache_dir / fname)
         
     return result
 
@@ -126,67 +260,99 @@ def runDiffpdf(first_fname: str, second_fname: str, output_dir: Path) -> subproc
 
     return result
 
-def markNode(latex_node, allowed_environments: set[str]) -> str:
-    counter = count(0)
-    def markStr(string, is_inline_math = False):
-        return rf'\markbox{{{"m" if is_inline_math else ""}{next(counter)}}}{{{string}}}'
-        
-    def recMark(node):
-        if node.isNodeType(LatexEnvironmentNode):
-            verbatim_contents = ''.join([n.latex_verbatim() for n in node.nodelist]) #every LatexEnvironmentNode has a nodelist
-            reconstructed_whole = rf'\begin{{{node.envname}}}{verbatim_contents}\end{{{node.envname}}}'
-            if node.latex_verbatim() != reconstructed_whole:
-                # not sure if I should only check this if the environment is among allowed_environments                
-                # but it's safer to check every environment encountered
-                logging.error(f"pylatexenc environment node {node.latex_verbatim()} in markNode was malformed or parsed incorrectly")
-                logging.debug(f"{verbatim_contents} != {reconstructed_whole}")                
-                sys.exit(1)
-            
-            if node.envname in allowed_environments:
-                marked_contents = ''
-                for nested_node in node.nodelist:
-                    marked_contents += recMark(nested_node)
-                return rf'\begin{{{node.envname}}}{marked_contents}\end{{{node.envname}}}'
-            else:
-                return reconstructed_whole
-            
-        elif node.isNodeType(LatexMacroNode):
-            return node.latex_verbatim()
-        elif node.isNodeType(LatexMathNode):
-            if node.displaytype == 'inline':
-                return markStr(node.latex_verbatim(), is_inline_math = True)
-            else:
-                return node.latex_verbatim()
-        elif node.isNodeType(LatexCharsNode):
+def markNode(latex_node, allowed_environments: frozenset[str]) -> str:
+    """return the source of latex_node with its words and inline equations wrapped in \\markbox-es (and the number of them).
+       The tree is walked with an explicit stack rather than recursion, so deeply nested documents can't hit the recursion limit"""
+    num_marks = 0 # also the number of the next \markbox
+
+    def markEnvironment(node):
+        begin, end = rf'\begin{{{node.envname}}}', rf'\end{{{node.envname}}}'
+        source = node.parsing_state.s
+        contents_start, contents_end = node.pos+len(begin), node.pos+node.len-len(end)
+        ## same as node.latex_verbatim() == begin + ''.join([n.latex_verbatim() for n in node.nodelist]) + end
+        ## (every LatexEnvironmentNode has a nodelist) but compares offsets instead of building both strings
+        if not (contents_start <= contents_end and source.startswith(begin, node.pos) and source.startswith(end, contents_end)
+                and nodesSpanSource(node.nodelist, source, contents_start, contents_end)):
+            # not sure if I should only check this if the environment is among allowed_environments                
+            # but it's safer to check every environment encountered
             verb_str = node.latex_verbatim()
-            ## mark every word in safe envs
-            ## I'm tempted to not worry about inserting between punctuation, but that will probably go poorly?
-            ## will definitely need to revamp how I'm finding text in the bibliography though. I might just segment it by bib or bibitem and then search each one
-            ## invdividually for a string difference kind of thing.
-            marked_str, num_subs = re.subn(r"(?<=[\t\n ])\b[a-zA-Z]+\b(?=[\t\n ])", lambda m: markStr(m.group(0)), verb_str)
-            logging.debug(f"marked {num_subs} words in {verb_str}")
-            return marked_str
-        elif node.isNodeType(LatexGroupNode):
-            # for the time being this means that naked group blocks are ignored---will need to revisit.
-            # Ultimately will likely use a different, simpler parser
+            verbatim_contents = ''.join([n.latex_verbatim() for n in node.nodelist])
+            logging.error(f"pylatexenc environment node {verb_str} in markNode was malformed or parsed incorrectly")
+            logging.debug(f"{verb_str} != {begin}{verbatim_contents}{end}")                
+            sys.exit(1)
+        
+        if node.envname in allowed_environments:
+            ## the contents are marked by the loop at the bottom, which pops them (and then the \end) next
+            stack.append(end)
+            stack.extend(reversed(node.nodelist))
+            return begin
+        else:
             return node.latex_verbatim()
+
+    def markMath(node):
+        nonlocal num_marks
+        if node.displaytype == 'inline':
+            num_marks += 1
+            return rf'\markbox{{m{num_marks-1}}}{{{node.latex_verbatim()}}}'
         else:
-            logging.warning(f"Encountered unrecognized latex node '{node.nodeType()}' during markNode().\n Writing node.latex_verbatim(): '{node.latex_verbatim()}'")
             return node.latex_verbatim()
+
+    def markChars(node):
+        nonlocal num_marks
+        verb_str = node.latex_verbatim()
+        ## mark every word in safe envs
+        ## I'm tempted to not worry about inserting between punctuation, but that will probably go poorly?
+        ## will definitely need to revamp how I'm finding text in the bibliography though. I might just segment it by bib or bibitem and then search each one
+        ## invdividually for a string difference kind of thing.
+        if not verb_str.strip():
+            return verb_str
+        parts = MARK_WORD_PATTERN.split(verb_str) # [text, word, text, word, ..., text]
+        for mark, i in enumerate(range(1, len(parts), 2), num_marks):
+            parts[i] = rf'\markbox{{{mark}}}{{{parts[i]}}}'
+        num_marks += len(parts)//2
+        logging.debug(f"marked {len(parts)//2} words in {verb_str}")
+        return ''.join(parts)
+
+    def verbatim(node):
+        return node.latex_verbatim()
+
+    def markUnrecognized(node):
+        verb_str = node.latex_verbatim()
+        logging.warning(f"Encountered unrecognized latex node '{node.nodeType()}' during markNode().\n Writing node.latex_verbatim(): '{verb_str}'")
+        return verb_str
+
+    ## dispatch on the exact node class, one dict lookup per node instead of a chain of isNodeType() calls
+    markers = {
+        LatexEnvironmentNode: markEnvironment,
+        LatexMacroNode: verbatim,
+        LatexMathNode: markMath,
+        LatexCharsNode: markChars,
+        # for the time being this means that naked group blocks are ignored---will need to revisit.
+        # Ultimately will likely use a different, simpler parser
+        LatexGroupNode: verbatim,
+    }
+
+    ## nodes still to be marked (and the plain strings which close marked environments), in reverse document order
+    stack = [latex_node]
+    marked = []
+    while stack:
+        node = stack.pop()
+        marked.append(node if type(node) is str else markers.get(type(node), markUnrecognized)(node))
         
-    return recMark(latex_node), next(counter)
+    return ''.join(marked), num_marks
 
 def get_preamble_and_document(nodelist):
     """Read in a list of pylatexenc.latexwalker.<Node>s and return the nodes which belong to the
        preamble and document"""
-    num_document_envs = len(list(filter(lambda n: n.isNodeType(LatexEnvironmentNode) and n.envname == 'document', nodelist)))
+    num_document_envs = 0
+    for j, node in enumerate(nodelist):
+        if node.isNodeType(LatexEnvironmentNode) and node.envname == 'document':
+            num_document_envs += 1
+            i = j # the index of the document environment
     if num_document_envs != 1:
         logging.error(r"Found more (or less) than one `\begin{document}`s during getPreambleAndDocument(). Exiting unsuccessfully.")
         sys.exit(1)
 
-    i = 0
-    while nodelist[i].nodeType() != LatexEnvironmentNode:
-        i += 1
     preamble_nodes = nodelist[:i]
     document_node = nodelist[i]
     
@@ -202,16 +368,11 @@ def scaledPointsToPDFpoints(sp: int):
     tex_pts = sp / SCALED_POINTS_PER_TEX_POINT
     return texPointsToPDFpoints(tex_pts)
 
-def unzipHbox(hbox):
-    return hbox[0], tuple(map(lambda pts: texPointsToPDFpoints(float(pts)), hbox[1:]))
-
-def unzipPos(stend_xy):
-    return stend_xy[0], tuple(map(lambda spts: scaledPointsToPDFpoints(int(spts)), stend_xy[1:-1]))
-
 def boxinfoToPDFRectangle(key, hbox, start_xy, end_xy):
-    pgA, (width, height, depth) = unzipHbox(hbox)
-    pgB, (x0, sy) = unzipPos(start_xy)
-    pgC, (x1, ey) = unzipPos(end_xy)
+    """hbox is (page, width, height, depth) and start_xy, end_xy are (page, x, y), already in PDF points. See getWordBoxes()"""
+    pgA, width, height, depth = hbox
+    pgB, x0, sy = start_xy
+    pgC, x1, ey = end_xy
 
     if pgB != pgC:
         logging.debug(f"box '{key}' spanned multiple pages ({pgA} {pgB} {pgC}; ignoring")
@@ -231,34 +392,49 @@ def boxinfoToPDFRectangle(key, hbox, start_xy, end_xy):
         
 def getWordBoxes(boxpositions_file_name: str, tot_num_boxes):
     word_boxes = dict()
-    not_colon = r'([^:]*)'
-
-    with open(boxpositions_file_name, 'r') as f:
-        line = f.readline().strip()
-        line_no = 1
-        while line:
-            box_info = re.match(fr"^(m?\d+):(pwhd|spxy|epxy):(\d+):{not_colon}:{not_colon}:{not_colon}$", line)
-            if box_info == None:
-                logging.error(f"Somehow line {line_no} of {boxpositions_file_name} '{repr(line)}' did not match the info spec. Exiting unsuccessfully.")
+
+    with open(boxpositions_file_name, 'rb') as f:
+        data = f.read()
+
+    def exitOnUnmatched(start, end):
+        ## everything between two matched lines has to be blank
+        gap = data[start:end]
+        if gap.strip():
+            bad_start = start + len(gap) - len(gap.lstrip())
+            line_no = data.count(b'\n', 0, bad_start) + 1
+            line = gap.lstrip().split(b'\n', 1)[0].strip().decode('utf-8', 'replace')
+            logging.error(f"Somehow line {line_no} of {boxpositions_file_name} '{repr(line)}' did not match the info spec. Exiting unsuccessfully.")
+            sys.exit(1)
+
+    ## one scan over the bytes instead of decoding, stripping and matching line by line; only the key and label
+    ## are decoded, int() and float() take the (ascii) numbers as bytes directly.
+    ## The dimensions (in TeX points) and positions (in scaled points) are converted to PDF points right away
+    pos = 0
+    for box_info in BOX_LINE_PATTERN.finditer(data):
+        exitOnUnmatched(pos, box_info.start())
+        pos = box_info.end()
+        key, label, page, first, second, third = box_info.groups()
+        key, label = key.decode('ascii'), label.decode('ascii')
+        if label == 'pwhd':
+            values = (int(page), texPointsToPDFpoints(float(first.removesuffix(b'pt'))),
+                      texPointsToPDFpoints(float(second.removesuffix(b'pt'))), texPointsToPDFpoints(float(third.removesuffix(b'pt'))))
+        else:
+            values = (int(page), scaledPointsToPDFpoints(int(first)), scaledPointsToPDFpoints(int(second)))
+        
+        if key in word_boxes:
+            if label in word_boxes[key]:
+                logging.error(f"""Somehow label '{label}' was already in '{word_boxes[key]}'.
+                There should be only three labels (and they should each appear at most once):
+                'pwhd' for page, width, height, depth; 'spxy' for start, page, x pos, y pos;
+                and 'epxy' for end, page, x pos, y pos""")
                 sys.exit(1)
-            matches = box_info.groups()
-            key, label, values = matches[0], matches[1], tuple(map(lambda m: m.strip('pt'), matches[2:]))
-            
-            if key in word_boxes:
-                if label in word_boxes[key]:
-                    logging.error(f"""Somehow label '{label}' was already in '{word_boxes[key]}'.
-                    There should be only three labels (and they should each appear at most once):
-                    'pwhd' for page, width, height, depth; 'spxy' for start, page, x pos, y pos;
-                    and 'epxy' for end, page, x pos, y pos""")
-                    sys.exit(1)
-                word_boxes[key][label] = values
-            else:
-                word_boxes[key] = {label:values}
-            line = f.readline().strip()
-            line_no += 1
+            word_boxes[key][label] = values
+        else:
+            word_boxes[key] = {label:values}
+    exitOnUnmatched(pos, len(data))
 
     ## all marks should have exactly three fields, the hbox dimensions, start xy, and end xy positions
-    if not all(filter(lambda x: x == 3, map(lambda d: len(d), list(word_boxes.values())))):
+    if not all(len(info) == 3 for info in word_boxes.values()):
         logging.error(f"Information extracted from marks somehow differed from spec.")
         sys.exit(1)
 
@@ -270,7 +446,7 @@ def getWordBoxes(boxpositions_file_name: str, tot_num_boxes):
         if res == None:
             continue
         one_indexed_pageno, rectangle = res
-        pageno = int(one_indexed_pageno) - 1
+        pageno = one_indexed_pageno - 1
         if pageno in page_rectangles:
             page_rectangles[pageno][key] = rectangle
         else:
@@ -280,30 +456,62 @@ def getWordBoxes(boxpositions_file_name: str, tot_num_boxes):
     logging.info(f"Used {num_used_boxes}/{tot_num_boxes} marked boxes.")
     return page_rectangles
 
-def segment(tex_filename: str) -> str:
-    r"""Return the TeX source that appears on outputted pages and as the arguments to certain dedicated commands or environments. Page-level partitioning is achieved with a hook to \shipout and frequent use of \mark. There's probably a better way, but this works..."""
-    
-    tex_str = sourceAsString(tex_filename)
-    latex_context = LatexContextDb()
-    # latex_context.add_context_category('macros',macros=[MacroSpec('mark', args_parser='{')])
-    nodelist, _, _ = LatexWalker(tex_str, latex_context=latex_context).get_latex_nodes(pos=0)
+def parseAndMark(tex_str: str) -> dict:
+    """parse tex_str once and return everything segment() needs from the parse: the metadata, the enunciations,
+       the preamble source and the marked document (with the number of marks in it)"""
+    nodelist = getLatexNodes(tex_str)
     
-    if ''.join([node.latex_verbatim() for node in nodelist]) != tex_str:
+    if not nodesSpanSource(nodelist, tex_str):
         logging.error(f"Verbatim string tex source was not preserved after LatexWalker parsing. The parser has likely failed. Exiting unsuccessfully.")
         sys.exit(1)
 
-    logging.info("Getting soup...")
-    soup = TexSoup(tex_str)
-    logging.info("Finished getting soup.")
-
     logging.info("Extracting metadata...")
-    enunciations = getEnunciations(soup)        
-    metadata = getMetadata(soup) # dict[str, list]
+    enunciations = getEnunciations(nodelist)
+    metadata = getMetadata(nodelist) # dict[str, list]
     preambleNodes, documentNode = get_preamble_and_document(nodelist)
 
     preamble_str = ''.join([node.latex_verbatim() for node in preambleNodes])
     logging.info("Done.")
 
+    logging.info("Inserting marks...")
+    marked_document, num_marks = markNode(documentNode, ALLOWED_MARK_ENVIRONMENTS | enunciations) # a frozenset, built once
+    logging.info("Done.")
+
+    return {'metadata': metadata, 'enunciations': enunciations, 'preamble': preamble_str,
+            'marked_document': marked_document, 'num_marks': num_marks}
+
+def parseCacheKey(tex_str: str) -> str:
+    """unlike pdflatex's output, the parse doesn't depend on the filename, so only the source is hashed"""
+    return hashlib.blake2b(f'{PARSE_CACHE_VERSION}:{tex_str}'.encode('utf-8')).hexdigest()
+
+def parseAndMarkCached(tex_str: str, output_dir: Path, use_cache: bool = True) -> dict:
+    """parseAndMark(), with the result pickled in output_dir/PARSE_CACHE_DIRNAME keyed on a hash of tex_str.
+       Only the extracted strings, dicts and sets are cached, not the pylatexenc nodes (which hold on to the
+       whole parser state), so a cache hit skips parsing and marking altogether"""
+    cache_file = output_dir / PARSE_CACHE_DIRNAME / f'{parseCacheKey(tex_str)}.pkl'
+    if use_cache and cache_file.exists():
+        logging.info(f"Using cached parse of the source from {cache_file}")
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+
+    parsed = parseAndMark(tex_str)
+    if use_cache:
+        Path.mkdir(cache_file.parent, parents = True, exist_ok = True)
+        with open(cache_file, 'wb') as f:
+            pickle.dump(parsed, f)
+    return parsed
+
+def segment(tex_filename: str, use_cache: bool = True) -> str:
+    r"""Return the TeX source that appears on outputted pages and as the arguments to certain dedicated commands or environments. Page-level partitioning is achieved with a hook to \shipout and frequent use of \mark. There's probably a better way, but this works..."""
+    
+    tex_str = sourceAsString(tex_filename)
+
+    tmp_dir = Path('tmp_segmentsource')
+    Path.mkdir(tmp_dir, exist_ok = True)
+
+    parsed = parseAndMarkCached(tex_str, tmp_dir, use_cache = use_cache)
+    preamble_str, marked_document, num_marks = parsed['preamble'], parsed['marked_document'], parsed['num_marks']
+
     mark_out_file = f'boxpositions_{Path(tex_filename).stem}.txt'
     tex_write_commands = fr"""
 \newwrite\markfile
@@ -321,22 +529,20 @@ def segment(tex_filename: str) -> str:
 }
 
 """
-    logging.info("Inserting marks...")
-    marked_document, num_marks = markNode(documentNode, ALLOWED_MARK_ENVIRONMENTS.union(enunciations))
-    logging.info("Done.")
-    
     marked_tex = preamble_str + tex_write_commands + markbox_def + marked_document
 
-    tmp_dir = Path('tmp_segmentsource')
-    Path.mkdir(tmp_dir, exist_ok = True)
     orig_filename = Path(tex_filename).name    
     marked_filename = Path(tex_filename).stem+'_marked.tex'
 
     def pdfFname(tex_fname):
         return Path(tex_fname).stem+'.pdf'
 
-    process1 = runPdflatex(tex_str, orig_filename, tmp_dir)
-    process2 = runPdflatex(marked_tex, marked_filename, tmp_dir)
+    ## the two compilations are independent (and have different jobnames, so their .aux and .log files don't collide)
+    ## and almost all of their time is spent waiting on the pdflatex subprocess, so run them at the same time
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        future1 = executor.submit(runPdflatex, tex_str, orig_filename, tmp_dir, use_cache = use_cache)
+        future2 = executor.submit(runPdflatex, marked_tex, marked_filename, tmp_dir, extra_outputs = (mark_out_file,), use_cache = use_cache)
+        process1, process2 = future1.result(), future2.result()
     process3 = runDiffpdf(pdfFname(orig_filename), pdfFname(marked_filename), tmp_dir)
 
     
@@ -348,6 +554,7 @@ if __name__ == '__main__':
                                      description = r'Segments source TeX by pages and metadata like \title, \author, \address, and abstract.')
     parser.add_argument('filename')
     parser.add_argument("-d", "--debug", action="store_true", help='debugging output')
+    parser.add_argument("--no-cache", action="store_true", help='always reparse the source and rerun pdflatex instead of reusing cached results')
     
     args = parser.parse_args()
     
@@ -356,6 +563,6 @@ if __name__ == '__main__':
     
     logging.basicConfig(level=_level, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    segment(filename)
+    segment(filename, use_cache = not args.no_cache)
 
     
@@ -1,111 +1,190 @@
 import pymupdf
+import numpy as np
 import argparse
-from texpdfedits.extract import getRobustAnnots, getCorrections, PDF_ANNOT_TEXT, PDF_ANNOT_CARET, PDF_ANNOT_STRIKE_OUT
+from texpdfedits.extract import getRobustAnnots, getCorrections, lineBBoxArray, releaseStore, LINE_BBOX_TEXT_FLAGS, SKIPPED_ANNOT_TYPE_CODES, PDF_ANNOT_TEXT, PDF_ANNOT_CARET, PDF_ANNOT_STRIKE_OUT
 from pathlib import Path
-
-import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, groupby
 
 def shipPdfFilename(filename, output_dir, unique_ending):
     out_dir = Path(output_dir)
     Path.mkdir(out_dir, exist_ok=True)
     return out_dir / f'{Path(filename).stem}_{unique_ending}.pdf'
 
-def drawAnnots(filename, output_dir, unique_ending = 'orig_annots'):
-    """draw bounding boxes of original annotations in annotated PDF"""
+def pageAnnotBoxes(page):
+    """
+    bounding boxes of the original annotations on page. Only the rect of each annotation is needed, so it's
+    read straight from the annotation's /Rect by xref instead of building a pymupdf.Annot for every annotation
+    """
+    doc = page.parent
+    ## /Rect is in PDF coordinates (y going up); pymupdf's are flipped
+    to_page = page.transformation_matrix
+    bbs = []
+    for xref, annot_type, _ in page.annot_xrefs():
+        if annot_type == PDF_ANNOT_TEXT[0] or annot_type in SKIPPED_ANNOT_TYPE_CODES:
+            continue
+        _, pdf_rect = doc.xref_get_key(xref, 'Rect') # '[x0 y0 x1 y1]'
+        bbs.append(tuple(pymupdf.Rect([float(v) for v in pdf_rect[1:-1].split()]) * to_page))
+    return bbs
+
+def _pagesBoxes(page_boxes, filename, pagenos):
+    """page_boxes(page) for each page of filename in pagenos (process pool worker)"""
+    page_bbs = []
+    with pymupdf.open(filename) as doc:
+        for pageno in pagenos:
+            page_bbs.append(page_boxes(doc[pageno]))
+            releaseStore() # from extract.py
+    return page_bbs
+
+def drawPagesBoxes(filename, page_boxes, color, jobs = 1):
+    """
+    return filename opened with a box drawn around each bounding box page_boxes(page) gives for every page.
+    The boxes are plain rectangles in the page contents, not annotations.
+
+    Finding the boxes is independent per page, so with jobs > 1 it is done in contiguous chunks of pages by that many
+    worker processes. The boxes are still drawn here on the original document: copying pages between documents with
+    insert_pdf would drop grouped (/IRT) annotations
+    """
     doc = pymupdf.open(filename)
-    for page in doc:
-        for annot in page.annots():
-            if annot.type == PDF_ANNOT_TEXT:
-                continue
-            box = page.add_freetext_annot(annot.rect, '', text_color=(1,0,1))
-            box.set_border(width=.5)
-            box.update()
-    doc.save(shipPdfFilename(filename, output_dir, unique_ending))
+    if jobs > 1 and doc.page_count > 1:
+        chunk_size = -(-doc.page_count // jobs)
+        chunks = [range(k, min(k + chunk_size, doc.page_count)) for k in range(0, doc.page_count, chunk_size)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            boxes = [bbs for chunk_boxes in executor.map(_pagesBoxes, repeat(page_boxes), repeat(filename), chunks)
+                     for bbs in chunk_boxes]
+    else:
+        boxes = [page_boxes(page) for page in doc]
+    for page, bbs in zip(doc, boxes):
+        if not bbs:
+            continue
+        shape = page.new_shape()
+        for bb in bbs:
+            shape.draw_rect(bb)
+        shape.finish(color=color, width=.5)
+        shape.commit()
+    return doc
+
+def drawAnnots(filename, output_dir, unique_ending = 'orig_annots', jobs = 1):
+    """draw bounding boxes of original annotations in annotated PDF"""
+    with drawPagesBoxes(filename, pageAnnotBoxes, (1,0,1), jobs) as doc:
+        doc.save(shipPdfFilename(filename, output_dir, unique_ending))
     return 0
 
 
 def drawRobustAnnots(filename, robust_annots, output_dir, unique_ending = 'robust_annots'):
     """draw bounding boxes of robust annotations"""
-    doc = pymupdf.open(filename)
-    for pageno,page in enumerate(doc):
-        for annot in annots[pageno]:
-            if annot.type == PDF_ANNOT_TEXT:
+    with pymupdf.open(filename) as doc:
+        for pageno,page in enumerate(doc):
+            page_annots = [annot for annot in robust_annots[pageno] if annot.type != PDF_ANNOT_TEXT]
+            if not page_annots:
                 continue
-            box = page.add_freetext_annot(annot.rect, '', text_color=(1,0,1))
-            box.set_border(width=.5)
-            box.update()
-    doc.save(shipPdfFilename(filename, output_dir, unique_ending))
+            shape = page.new_shape()
+            for annot in page_annots:
+                shape.draw_rect(annot.rect)
+            shape.finish(color=(1,0,1), width=.5)
+            shape.commit()
+        doc.save(shipPdfFilename(filename, output_dir, unique_ending))
     return 0
 
 
-def drawLines(filename, output_dir, unique_ending = 'lines'):
+def pageLineBoxes(page):
+    """bounding boxes of the lines from page.get_text('dict', sort=True)['blocks']"""
+    blocks = page.get_text('dict', flags=LINE_BBOX_TEXT_FLAGS, sort=True)['blocks']
+    line_bbs = lineBBoxArray(blocks) # from extract.py
+    ## empty bboxes wouldn't show up anyway
+    line_bbs = line_bbs[(line_bbs[:,0] < line_bbs[:,2]) & (line_bbs[:,1] < line_bbs[:,3])]
+    return line_bbs.tolist()
+
+def drawLines(filename, output_dir, unique_ending = 'lines', jobs = 1):
     """draw the bounding boxes of the lines from page.get_text('dict', sort=True)['blocks']"""
-    doc = pymupdf.open(filename)
-    for page in doc:
-        blocks = page.get_text('dict', sort=True)['blocks']
-        line_bbs = []
-        line_bbs = [line['bbox'] for block in blocks for line in block['lines']]        
-        for bb in line_bbs:
-            box = page.add_freetext_annot(bb, '', text_color=(1,0,0))
-            box.set_border(width=.5)
-            box.update()
-    doc.save(shipPdfFilename(filename, output_dir, unique_ending))
+    with drawPagesBoxes(filename, pageLineBoxes, (1,0,0), jobs) as doc:
+        doc.save(shipPdfFilename(filename, output_dir, unique_ending))
     return 0
 
-def drawEdits(filename, output_dir, unique_ending = 'edit_selections'):
+## colors of the debug bboxes of a correction, in order
+CARET_EDIT_COLORS = ((1,0,0), (0,0,1))
+EDIT_COLORS = ((1,.25,.25), (.25,1,.25), (.25,.25,1))
+
+def drawEdit(page, correction):
+    """draw the selection bboxes and the Edit json of correction on page (a copy of the page correction is on)"""
+    bbs = np.array([tuple(bb) for bb in correction.debug_bbs], dtype=np.float64).reshape(-1, 4)
+    colors = CARET_EDIT_COLORS if correction.type == PDF_ANNOT_CARET[1] else EDIT_COLORS
+    ## empty bboxes (e.g. of an empty selection) and ones off the page wouldn't show up
+    page_x0, page_y0, page_x1, page_y1 = page.rect
+    visible = ((bbs[:,0] < bbs[:,2]) & (bbs[:,1] < bbs[:,3])
+               & (bbs[:,2] > page_x0) & (bbs[:,0] < page_x1) & (bbs[:,3] > page_y0) & (bbs[:,1] < page_y1))
+    ## the bboxes are just drawn onto the page; only the Edit text needs to be an annotation
+    for j in np.flatnonzero(visible):
+        page.draw_rect(bbs[j].tolist(), color=colors[j], width=.75)
+    ## add_freetext_annot already builds the appearance stream
+    page.add_freetext_annot((5,5,500,350), str(correction), fontsize=10, fontname="Cour", text_color=(.7, .2, .5))
+
+def _editPages(filename, numbered_corrections, num_corrections, serialize = False):
+    """
+    return documents with one page per (i, correction) in numbered_corrections, in order, with the correction drawn on it
+    (see drawEdit()). With serialize the documents are returned as PDF bytes (pymupdf documents can't be sent back from
+    a process pool worker).
+
+    Corrections come in page order, so each run of corrections on the same page shares a document: the page is copied out
+    of the source PDF once and duplicated within that document for the rest of the run
+    """
+    edit_docs = []
+    with pymupdf.open(filename) as src_doc: # parsed once
+        for pageno, page_corrections in groupby(numbered_corrections, key=lambda ic: ic[1].pageno):
+            page_corrections = list(page_corrections)
+            edit_doc = pymupdf.open()
+            edit_doc.insert_pdf(src_doc, from_page=pageno, to_page=pageno)
+            for _ in page_corrections[1:]:
+                edit_doc.fullcopy_page(0)
+            for page, (i, correction) in zip(edit_doc, page_corrections):
+                drawEdit(page, correction)
+                print(f'{i:3d}/{num_corrections:3d}')
+            if serialize:
+                edit_docs.append(edit_doc.tobytes())
+                edit_doc.close()
+            else:
+                edit_docs.append(edit_doc)
+            releaseStore()
+    return edit_docs
+
+def drawEdits(filename, output_dir, unique_ending = 'edit_selections', jobs = 1):
     """draw the bounding boxes for extracting the selected text and the Edit json for each annotation
        yes this is more messy than it needs to be
+
+       Each correction gets its own page in the combined PDF. The pages are independent, so with jobs > 1
+       they are drawn by that many worker processes
     """
-    corrections = getCorrections(filename)
+    corrections = getCorrections(filename, jobs)
+    combined_fname = shipPdfFilename(filename, output_dir, unique_ending)
     
-    out_str = ''
-    single_fname_prefix = Path(output_dir) / f'{Path(filename).stem}_{unique_ending}'
-    singlepage_file_names = []
     print(f'Extracting annotations from {filename}...')
-    for i, correction in enumerate(corrections):
-        doc = pymupdf.open(filename)
-        page_count = doc.page_count
-        if correction.pageno < page_count-1:
-            doc.delete_pages(from_page=correction.pageno+1)
-        if correction.pageno >= 1:
-            doc.delete_pages(from_page=0, to_page=correction.pageno-1)
-        assert doc.page_count == 1, "doc.page_count != 1"
-        page = doc[0]
-        bbs = correction.debug_bbs
-        colors = [(1,0,0), (0,0,1)] if correction.type == PDF_ANNOT_CARET[1] else [(1,.25,.25), (.25,1,.25), (.25,.25,1)]
-        for j, bb in enumerate(bbs):
-            if bb.width == 0:
-                continue
-            box = page.add_freetext_annot(bb, '', text_color=colors[j])
-            box.set_border(width=.75)
-            box.update()
-        box = page.add_freetext_annot((5,5,500,350), str(correction), fontsize=10, fontname="Cour", text_color=(.7, .2, .5))
-        box.update()
-
-        single_save = f'{single_fname_prefix}_{i}.pdf'
-        doc.save(single_save)
-
-        out_str += f'{single_save}\n{i} {correction}\n\n'
-        
-        singlepage_file_names.append(single_save)
-        print(f'{i:3d}/{len(corrections):3d}')
-
-    print(f'done. Files written to {output_dir}')
-    combined_doc = pymupdf.open(filename)
-    ## silly, but I'm not aware of a simpler way
-    combined_doc.delete_pages(from_page=0, to_page=combined_doc.page_count-1)
-    for single_page in singlepage_file_names:
-        single_pdf = pymupdf.open(single_page)
-        combined_doc.insert_pdf(single_pdf, annots=True)
-        
-    combined_doc.save(shipPdfFilename(filename, output_dir, unique_ending))
-
-    print(f"Combined doc saved to {Path(output_dir)}...")
-    print("Deleting intermediate PDFs...")
-    
-    os.system(f"rm {single_fname_prefix}_*.pdf")
+    numbered_corrections = list(enumerate(corrections))
+    if jobs > 1 and corrections:
+        # pymupdf documents can't be shared between processes, so every worker opens its own copy.
+        # The chunks are contiguous, so the pages come back in order
+        chunk_size = -(-len(corrections) // jobs)
+        chunks = [numbered_corrections[k:k+chunk_size] for k in range(0, len(corrections), chunk_size)]
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunk_pages = list(executor.map(_editPages, repeat(filename), chunks, repeat(len(corrections)), repeat(True)))
+        ## opened one at a time while merging, so only one drawn document is alive at once
+        edit_docs = (pymupdf.open('pdf', doc_bytes) for docs in chunk_pages for doc_bytes in docs)
+    else:
+        edit_docs = _editPages(filename, numbered_corrections, len(corrections))
+
+    ## the drawn pages are kept open and inserted straight into an empty document instead of being saved and reopened
+    with pymupdf.open() as combined_doc:
+        for edit_doc in edit_docs:
+            combined_doc.insert_pdf(edit_doc, annots=True)
+            edit_doc.close()
+        ## format the path once, not once per correction
+        combined_str = str(combined_fname)
+        out_str = ''.join(f'{combined_str} page {i+1}\n{i} {correction}\n\n' for i, correction in enumerate(corrections))
+
+        combined_doc.save(combined_fname)
+
+    print(f"done. Combined doc saved to {Path(output_dir)}...")
     
-    with open(f'{Path(output_dir) / Path(filename).stem}_corrections_out.txt', 'w') as f:
+    with open(combined_fname.with_name(f'{Path(filename).stem}_corrections_out.txt'), 'w') as f:
         f.write(out_str)
 
     return 0
@@ -114,6 +193,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog = 'python draw_bbs.py',
                                      description = 'Draw various bounding boxes')
     parser.add_argument('filename')
+    parser.add_argument("-j", "--jobs", type=int, default=1, help='number of processes used to read the annotations and draw the pages')
     args = parser.parse_args()
     filename = args.filename
 
@@ -122,11 +202,11 @@ if __name__ == '__main__':
     annots = getRobustAnnots(doc) # from extract.py
     bb_dir = Path('bbox_drawings')
     
-    drawAnnots(filename, bb_dir)
+    drawAnnots(filename, bb_dir, jobs = args.jobs)
     drawRobustAnnots(filename, annots, bb_dir)
-    drawLines(filename, bb_dir)
+    drawLines(filename, bb_dir, jobs = args.jobs)
 
-    drawEdits(filename, bb_dir)
+    drawEdits(filename, bb_dir, jobs = args.jobs)
 
     
     
@@ -10,15 +10,12 @@ def drawWordBoxes(pdf_filename, page_word_rectangles, output_dir):
     doc = pymupdf.open(pdf_filename)
     for pg_no in page_word_rectangles:
         page = doc[pg_no]
-        page_height = page.rect.height
-        def toPymuY(y):
-            nonlocal page_height
-            return page_height - y
-        for key, bb in page_word_rectangles[pg_no].items():
-            x0, y0, x1, y1 = bb
-            y0 = toPymuY(y0)
-            y1 = toPymuY(y1)
-            box = page.add_freetext_annot((x0, y0, x1, y1), key, text_color=(0,.25,.7), fontsize=3, fontname="Cour")
+        h = page.rect.height
+        add = page.add_freetext_annot
+        for key, (x0, y0, x1, y1) in page_word_rectangles[pg_no].items():
+            ## pdflatex y is measured up from the bottom, pymupdf's down from the top
+            ## set_border() rather than border_width=, which would grow the rect by half the border and drop the /S style
+            box = add((x0, h - y0, x1, h - y1), key, text_color=(0,.25,.7), fontsize=3, fontname="Cour")
             box.set_border(width=.3)
             box.update()
             